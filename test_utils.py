@@ -0,0 +1,205 @@
+import csv
+import io
+from time import monotonic, sleep
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
+import lightkurve as lk
+from astropy.io import fits
+from lightkurve.io.kepler import read_kepler_lightcurve
+from lightkurve.utils import LightkurveError
+
+import utils
+
+def _write_quarter(path, time, flux, quarter, kepler_id=1234):
+    """
+    Write a minimal Kepler long-cadence lightcurve file with the given time and (PDCSAP) flux.
+    """
+    flux_err = np.full_like(flux, 0.5)
+    columns = [fits.Column(name='TIME', format='D', array=time),
+               fits.Column(name='CADENCENO', format='J', array=np.arange(len(time))),
+               fits.Column(name='SAP_FLUX', format='E', array=flux),
+               fits.Column(name='SAP_FLUX_ERR', format='E', array=flux_err),
+               fits.Column(name='PDCSAP_FLUX', format='E', array=flux),
+               fits.Column(name='PDCSAP_FLUX_ERR', format='E', array=flux_err),
+               fits.Column(name='SAP_QUALITY', format='J', array=np.zeros(len(time), dtype=np.int32))]
+    primary = fits.PrimaryHDU()
+    primary.header['TELESCOP'] = 'Kepler'
+    primary.header['INSTRUME'] = 'Kepler Photometer'
+    primary.header['OBJECT'] = f'KIC {kepler_id}'
+    primary.header['KEPLERID'] = kepler_id
+    primary.header['QUARTER'] = quarter
+    primary.header['OBSMODE'] = 'long cadence'
+    table = fits.BinTableHDU.from_columns(columns, name='LIGHTCURVE')
+    fits.HDUList([primary, table]).writeto(path)
+
+def test_stitch_quarters_reads_kepler_files(tmp_path):
+    # Two quarters with a linear trend and NaN gaps, as in real Kepler data
+    curves = []
+    for quarter, (t0, n) in enumerate([(130., 200), (230., 150)], start=1):
+        time = t0 + np.arange(n) * 0.0204
+        flux = (1000. + 2.*(time - t0)).astype(np.float32)
+        flux[10:15] = np.nan
+        path = tmp_path / f'kplr000001234-q{quarter}_llc.fits'
+        _write_quarter(path, time, flux, quarter)
+        curves.append(read_kepler_lightcurve(str(path)))
+    tot_time, tot_flux, tot_flux_err, tot_qual = utils.stitch_quarters(lk.LightCurveCollection(curves))
+
+    for values in (tot_time, tot_flux, tot_flux_err, tot_qual):
+        assert type(values) is np.ndarray
+        assert len(values) == 350
+    gaps = np.zeros(350, dtype=bool)
+    gaps[10:15] = gaps[210:215] = True
+    assert np.isnan(tot_flux[gaps]).all()
+    assert np.isnan(tot_flux_err[gaps]).all()
+    np.testing.assert_allclose(tot_flux[~gaps], 1., rtol=1e-5) # linear trend divided out
+    np.testing.assert_allclose(tot_time[200:], 230. + np.arange(150) * 0.0204)
+    assert (tot_qual == 0).all()
+
+class _FakeSearchResult:
+    '''
+    Stands in for a Lightkurve SearchResult whose download_all fails a given number of times.
+    '''
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def download_all(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return 'collection'
+
+def test_download_lc_retries_rate_limited_downloads(monkeypatch):
+    # What Lightkurve raises when astroquery reports a failed file download
+    error = LightkurveError('Download of https://mast.stsci.edu/kplr000001234-2009131105131_llc.fits failed. '
+                            'MAST returns ERROR: Error: 429 Client Error: Too Many Requests for url')
+    search = _FakeSearchResult([error, error])
+    waits = []
+    monkeypatch.setattr(utils.lk, 'search_lightcurve', lambda *args, **kwargs: search)
+    monkeypatch.setattr(utils, 'sleep', waits.append)
+    assert utils._download_lc(1234, backoff=2) == 'collection'
+    assert search.calls == 3
+    assert waits == [2, 4]
+
+def test_download_lc_raises_other_errors(monkeypatch):
+    search = _FakeSearchResult([LightkurveError('Download of kplr004291234-2009131105131_llc.fits failed. '
+                                                'MAST returns ERROR: Error: 404 Not Found')])
+    monkeypatch.setattr(utils.lk, 'search_lightcurve', lambda *args, **kwargs: search)
+    monkeypatch.setattr(utils, 'sleep', lambda seconds: None)
+    with pytest.raises(LightkurveError):
+        utils._download_lc(1234)
+    assert search.calls == 1
+
+def test_download_lc_gives_up_after_max_retries(monkeypatch):
+    search = _FakeSearchResult([LightkurveError('429 Too Many Requests')] * 3)
+    monkeypatch.setattr(utils.lk, 'search_lightcurve', lambda *args, **kwargs: search)
+    monkeypatch.setattr(utils, 'sleep', lambda seconds: None)
+    with pytest.raises(LightkurveError):
+        utils._download_lc(1234, max_retries=3)
+    assert search.calls == 3
+
+def test_csv_line_matches_csv_writer():
+    values = np.array([1.0, 0.1 + 0.2, -2.5e-7, np.nan, 3.0])
+    expected = io.StringIO()
+    csv.writer(expected).writerow(values)
+    assert utils._csv_line(values) == expected.getvalue()
+    expected = io.StringIO()
+    csv.writer(expected).writerow(np.array([1]))
+    assert utils._csv_line(1) == expected.getvalue()
+
+def test_iter_curves_downloads_each_star_once(monkeypatch):
+    calls = []
+    def fake_process_curve(star, target, *args):
+        calls.append(star)
+        return np.full(len(target), float(star)), target
+    monkeypatch.setattr(utils, '_process_curve', fake_process_curve)
+    all_ids = np.array([7, 3, 7, 5, 3, 7])
+    ids_labels = np.array([1, 0, 1, 0, 0, 1])
+    results = list(utils._iter_curves(all_ids, ids_labels, n_timesteps=4, n_workers=2))
+    assert sorted(calls) == [3, 5, 7]
+    assert sorted(i for i, _, _, _ in results) == list(range(len(all_ids)))
+    for i, flux, time, label in results:
+        assert (flux == all_ids[i]).all()
+        assert label == ids_labels[i]
+
+def test_get_lc_downloads_when_cached_file_is_corrupt(tmp_path, monkeypatch):
+    quarter_dir = tmp_path / 'mastDownload' / 'Kepler' / 'kplr000001234_lc_Q111111111111111111'
+    quarter_dir.mkdir(parents=True)
+    (quarter_dir / 'kplr000001234-2009131105131_llc.fits').write_bytes(b'SIMPLE  =') # cut-short download
+    monkeypatch.setattr(utils.lk.config, 'get_cache_dir', lambda: str(tmp_path))
+    monkeypatch.setattr(utils, '_download_lc', lambda star: 'collection')
+    assert utils._cached_lc(1234) is None
+    assert utils._get_lc(1234) == 'collection'
+
+def test_stitched_lc_caches_downloads(tmp_path, monkeypatch):
+    downloads = []
+    monkeypatch.setattr(utils, '_download_lc', lambda star: downloads.append(star) or 'collection')
+    monkeypatch.setattr(utils, 'stitch_quarters', lambda lc_collection: tuple(np.arange(5.) + k for k in range(4)))
+    first = utils._stitched_lc(1234, cache_dir=str(tmp_path))
+    second = utils._stitched_lc(1234, cache_dir=str(tmp_path))
+    assert downloads == [1234]
+    assert (tmp_path / 'KIC1234_Kepler_long.npz').exists()
+    for a, b in zip(first, second):
+        np.testing.assert_array_equal(a, b)
+
+class _FailingFile:
+    '''
+    A file whose writes always fail, as on a full disk.
+    '''
+    def write(self, text):
+        raise OSError('No space left on device')
+
+def _wait_for(condition, timeout=5):
+    deadline = monotonic() + timeout
+    while not condition():
+        assert monotonic() < deadline, 'timed out'
+        sleep(0.01)
+
+def test_background_writer_writes_rows_to_all_files():
+    files = (io.StringIO(), io.StringIO(), io.StringIO())
+    writer = utils._BackgroundWriter(files, write_batch=4)
+    for n in range(10):
+        writer.put((f'flux{n}\r\n', f'time{n}\r\n', f'label{n}\r\n'))
+    writer.close()
+    for f, name in zip(files, ['flux', 'time', 'label']):
+        assert f.getvalue() == ''.join(f'{name}{n}\r\n' for n in range(10))
+
+def test_background_writer_flushes_partial_batch_on_timer():
+    files = (io.StringIO(), io.StringIO(), io.StringIO())
+    writer = utils._BackgroundWriter(files, write_batch=64, flush_interval=0.2)
+    writer.put(('a\r\n', 'b\r\n', 'c\r\n'))
+    # Well short of write_batch rows, so only the timer writes this row
+    _wait_for(lambda: files[2].getvalue() == 'c\r\n')
+    assert files[0].getvalue() == 'a\r\n'
+    writer.close()
+    assert files[1].getvalue() == 'b\r\n'
+
+def test_background_writer_reraises_write_errors_without_blocking():
+    writer = utils._BackgroundWriter((io.StringIO(), _FailingFile(), io.StringIO()), write_batch=1, max_queued=2)
+    # The queue only holds 2 rows, so this would block forever if the writer stopped reading it
+    with pytest.raises(OSError):
+        for n in range(1000):
+            writer.put(('a\r\n', 'b\r\n', 'c\r\n'))
+    with pytest.raises(OSError):
+        writer.close()
+    assert not writer.thread.is_alive()
+
+def test_collect_curves_toparquet_round_trip(tmp_path, monkeypatch):
+    def fake_process_curve(star, target, *args):
+        return np.linspace(0, 1, len(target)) * star, target
+    monkeypatch.setattr(utils, '_process_curve', fake_process_curve)
+    monkeypatch.setattr(utils, '_sample_ids', lambda n_curves, pct_transit, seed: (np.array([11, 22]), np.array([0, 1])))
+    utils.collect_curves_toparquet(2, n_timesteps=5, pct_transit=50, savepath=str(tmp_path), n_workers=1, write_batch=1)
+    dirpath = tmp_path / 'curves_5_50'
+    (part,) = dirpath.iterdir()
+    assert pq.ParquetFile(part).metadata.num_row_groups == 2 # one per batch
+    data = pd.read_parquet(dirpath).sort_values('kepid', ignore_index=True)
+    assert data['label'].dtype == np.int8
+    assert data['kepid'].tolist() == [11, 22]
+    assert data['label'].tolist() == [0, 1]
+    for row, star in zip(data.itertuples(), [11, 22]):
+        assert row.flux.dtype == np.float32 and row.time.dtype == np.float32
+        np.testing.assert_allclose(row.flux, np.linspace(0, 1, 5) * star, rtol=1e-6)
+        np.testing.assert_array_equal(row.time, np.arange(5))
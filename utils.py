@@ -7,13 +7,38 @@ Functions for use in Transit Classification aglorithms
 import numpy as np
 import pandas as pd
 import lightkurve as lk
-from scipy.optimize import curve_fit
+from lightkurve.utils import LightkurveError
 from scipy.signal import medfilt
-from scipy.stats import binned_statistic
-import csv
 import os
-from scipy.signal import medfilt
-from scipy.stats import binned_statistic
+import re
+from glob import glob
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from contextlib import closing
+from functools import lru_cache
+from time import sleep, time_ns, monotonic
+from queue import Queue, Empty
+from threading import Thread, get_ident
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+KOI_CSV = 'Data/exoplanet_archive_KOIs.csv'
+KOI_PARQUET = 'Data/exoplanet_archive_KOIs.parquet'
+
+@lru_cache(maxsize=None)
+def _koi():
+    """
+    Load the Kepler IDs and dispositions from the KOI table. Only the two columns we need
+    are parsed, and they are cached in a parquet file next to the csv (rebuilt if the csv
+    changes) and in memory, so repeated calls in a notebook session are free.
+    ----------
+    Returns:
+        data (pandas DataFrame): 'kepid' (int64) and 'koi_disposition' (category) columns.
+    """
+    if os.path.exists(KOI_PARQUET) and os.path.getmtime(KOI_PARQUET) >= os.path.getmtime(KOI_CSV):
+        return pd.read_parquet(KOI_PARQUET)
+    data = pd.read_csv(KOI_CSV, usecols=['kepid', 'koi_disposition'], dtype={'kepid': 'int64', 'koi_disposition': 'category'})
+    data.to_parquet(KOI_PARQUET)
+    return data
 
 def linear_func(x, a, b):
     """
@@ -29,6 +54,43 @@ def linear_func(x, a, b):
     """
     return a*x + b
 
+def fit_linear(x, y):
+    """
+    Closed-form least-squares fit of linear_func to data. Much faster than a general
+    nonlinear fit (e.g. curve_fit) for a straight line. x is centered first to avoid
+    losing precision when its offset is large compared to its range (e.g. Kepler times).
+    ----------
+    Parameters:
+        x (numpy array): x-values
+        y (numpy array): y-values
+    ----------
+    Returns:
+        a (float): best-fit slope
+        b (float): best-fit intercept
+    """
+    x_mean = x.mean()
+    y_mean = y.mean()
+    dx = x - x_mean
+    a = np.dot(dx, y - y_mean) / np.dot(dx, dx)
+    b = y_mean - a*x_mean
+    return a, b
+
+def _unmasked(values):
+    """
+    Plain float array of a lightcurve column. Lightkurve reads FITS columns with NaNs masked
+    (astropy Masked arrays), which numpy refuses to write into an unmasked out= array, so
+    masked entries are filled with NaN.
+    ----------
+    Parameters:
+        values (array-like): column values, masked or not
+    ----------
+    Returns:
+        values (numpy array): unmasked float values
+    """
+    if hasattr(values, 'filled'): # astropy Masked and numpy masked arrays
+        values = values.filled(np.nan)
+    return np.asarray(values, dtype=np.float64)
+
 def stitch_quarters(lc_collection): 
     """
     Linearly detrend each "quarter" (interval of observing) of the data, 
@@ -45,32 +107,467 @@ def stitch_quarters(lc_collection):
         tot_flux_err (numpy array): stitched flux error values
         tot_qual (numpy array): stitched data quality flag values
     """
-    tot_time = np.zeros(0) # to store concatenated arrays
-    tot_flux = np.zeros(0)
-    tot_flux_err = np.zeros(0)
-    tot_qual = np.zeros(0)
-    for i in range(len(lc_collection)):
-        lc = lc_collection[i]
-        flux = lc.flux.value
-        time = lc.time.value
-        flux_err = lc.flux_err.value
-        qual = lc.quality
-        rel_flux_err = flux_err/flux
-        nan_mask = np.invert(np.isnan(flux))
+    # Read each quarter's columns once. These may be views of the lightcurve's data, so they
+    # must not be modified; results are written straight into the stitched arrays instead.
+    quarters = [(_unmasked(lc.time.value), _unmasked(lc.flux.value), _unmasked(lc.flux_err.value),
+                 _unmasked(lc.quality)) for lc in lc_collection]
+    n_tot = sum(len(time) for time, _, _, _ in quarters)
+    tot_time = np.empty(n_tot)
+    tot_flux = np.empty(n_tot)
+    tot_flux_err = np.empty(n_tot)
+    tot_qual = np.empty(n_tot)
+    start = 0
+    for time, flux, flux_err, qual in quarters:
+        stop = start + len(time)
+        tot_time[start:stop] = time
+        tot_qual[start:stop] = qual
+        np.divide(flux_err, flux, out=tot_flux_err[start:stop]) # relative flux error
+        nan_mask = ~np.isnan(flux)
         
         # Fit and remove linear trend
-        popt, pcov = curve_fit(linear_func, time[nan_mask], flux[nan_mask])
-        linear_trend = linear_func(time, *popt) # evaluate over the whole interval
-        norm = flux / linear_trend
-        
-        tot_time = np.hstack([tot_time, time])
-        tot_flux = np.hstack([tot_flux, norm])
-        tot_flux_err = np.hstack([tot_flux_err, rel_flux_err])
-        tot_qual = np.hstack([tot_qual, qual])
+        popt = fit_linear(time[nan_mask], flux[nan_mask])
+        norm = tot_flux[start:stop]
+        np.multiply(time, popt[0], out=norm) # evaluate the trend over the whole interval...
+        norm += popt[1]
+        np.divide(flux, norm, out=norm) # ...and divide it out
+        start = stop
         
     return tot_time, tot_flux, tot_flux_err, tot_qual
 
-def collect_curves(n_curves, n_timesteps=1000, downsize_method='interpolate', pct_transit=49):
+@lru_cache(maxsize=16)
+def _source_grid(n_timesteps, length):
+    """
+    Positions of the points of a curve of the given length on the interpolation grid,
+    np.linspace(0, n_timesteps-1, length). Many Kepler stars have curves of the same length,
+    so these are cached (read-only) instead of being rebuilt for every star.
+    """
+    source = np.linspace(0, n_timesteps-1, length)
+    source.setflags(write=False)
+    return source
+
+def _postprocess(time, flux, flux_err, quality, target, downsize_method='interpolate'):
+    """
+    Set poor quality data to NaN and force a stitched lightcurve to a fixed length.
+    ----------
+    Parameters:
+        time, flux, flux_err, quality (numpy arrays): stitched lightcurve, as returned by
+                stitch_quarters. flux is modified in place.
+        target (numpy array): grid to interpolate onto, np.arange(n_timesteps).
+                Build this once and reuse it for every curve.
+        downsize_method: method to force curves to n_timesteps. Options are 'interpolate' or 'truncate'.
+    ----------
+    Returns:
+        flux (numpy array): flux values, of length n_timesteps (or less, if truncating a short curve)
+        time (numpy array): corresponding time values
+    """
+    n_timesteps = len(target)
+    # Set poor quality data to NaN
+    good = (quality == 0) & (flux_err > 0) & np.isfinite(time) & np.isfinite(flux) & np.isfinite(flux_err)
+    flux[~good] = np.NaN
+    # Force to length n_timesteps
+    if downsize_method == 'interpolate':
+        source = _source_grid(n_timesteps, len(flux)) # same for flux and time
+        flux = np.interp(target, source, flux)
+        time = np.interp(target, source, time)
+    if downsize_method == 'truncate':
+        flux = flux[0:n_timesteps]
+        time = time[0:n_timesteps]
+    return flux, time
+
+def _stitched_lc(star, cache_dir=None):
+    """
+    Get the stitched lightcurve of one star (see stitch_quarters), caching the result on disk
+    so that re-runs (e.g. of a notebook) skip both the download and the stitching.
+    Quarters always come from a complete download_all (see _download_lc), which reuses files
+    already in the Lightkurve cache and only fetches missing ones, so a partial set of cached
+    quarters (see _get_lc) is never stored. Delete the cache directory to start from scratch.
+    ----------
+    Parameters:
+        star (int): KIC ID of the star.
+        cache_dir (str): directory to cache stitched lightcurves in. Default is a "stitched"
+                folder in the Lightkurve cache.
+    ----------
+    Returns:
+        time, flux, flux_err, quality (numpy arrays): as returned by stitch_quarters.
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(lk.config.get_cache_dir(), 'stitched')
+    path = os.path.join(cache_dir, f'KIC{star}_Kepler_long.npz')
+    if os.path.exists(path):
+        with np.load(path) as cached:
+            return cached['time'], cached['flux'], cached['flux_err'], cached['quality']
+    time, flux, flux_err, quality = stitch_quarters(_download_lc(star))
+    # Write to a temporary file first, so other threads never see a half-written file
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}-{get_ident()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez_compressed(f, time=time, flux=flux, flux_err=flux_err, quality=quality)
+    os.replace(tmp_path, path)
+    return time, flux, flux_err, quality
+
+def _phase_fold(curve, n_bins):
+    """
+    Phase fold a lightcurve on its strongest Box Least Squares period, and bin it.
+    ----------
+    Parameters:
+        curve (lightcurve collection): all quarters of lightcurve data for the star.
+        n_bins: number of bins to use to bin the folded lightcurve.
+    ----------
+    Returns:
+        flux (numpy array): binned and smoothed folded flux values, of length n_bins
+        time (numpy array): corresponding (right) bin edges, in folded time
+    """
+    curve = curve.stitch().flatten(window_length=901).remove_outliers()
+    # Periods to search. The period resolution BLS needs scales with the period
+    # itself, so log spacing covers 1-30 days with far fewer trials than a linear grid
+    period = np.geomspace(1, 30, 2000)
+    # Create a BLSPeriodogram (over Lightkurve's default grid of trial durations)
+    bls = curve.to_periodogram(method='bls', period=period, frequency_factor=500)
+    period = bls.period_at_max_power
+    t0 = bls.transit_time_at_max_power
+    dur = bls.duration_at_max_power
+    folded = curve.fold(period=period, epoch_time=t0)
+    folded_flux = folded.flux.value
+    folded_time = folded.time.value
+    planet_model = bls.get_transit_model(period=period,
+                                         transit_time=t0,
+                                         duration=dur).fold(period, t0)
+    binned, bin_edges = _binned_median(folded_time, folded_flux, n_bins)
+    folded_smoothed_time = bin_edges[1:]
+    folded_smoothed_flux = medfilt(binned,3)
+    return folded_smoothed_flux, folded_smoothed_time
+
+def _process_curve(star, target, downsize_method='interpolate', phase_fold=False, smooth=False):
+    """
+    Download one star and turn it into flux and time arrays of a fixed length.
+    ----------
+    Parameters:
+        star (int): KIC ID of the star.
+        target (numpy array): grid to interpolate onto, np.arange(n_timesteps).
+        downsize_method: method to force curves to n_timesteps. Options are 'interpolate' or 'truncate'.
+        phase_fold: if True, will phase fold and bin the lightcurve into n_timesteps bins.
+        smooth: if True, will smooth the lightcurve (if not phase folding).
+    ----------
+    Returns:
+        flux (numpy array): flux values, of length n_timesteps (or less, if truncating a short curve)
+        time (numpy array): corresponding time values (or phase fold bin edges)
+    """
+    if phase_fold:
+        # Phase fold (this works on Lightkurve's own stitched and flattened curve, so there's
+        # no need to stitch or smooth the quarters ourselves)
+        return _phase_fold(_get_lc(star), len(target))
+    # "Stich" together quarters
+    time, flux, flux_err, quality = _stitched_lc(star)
+    if smooth:
+        # Smooth to remove stellar variability
+        flux = flux/medfilt(flux,51)
+    # Remove poor quality data and force to length n_timesteps
+    return _postprocess(time, flux, flux_err, quality, target, downsize_method)
+
+def _csv_line(values):
+    """
+    Format values as one line of a csv file. Same output as csv.writer (including its
+    \\r\\n line ending), but without converting each value through a separate numpy scalar.
+    ----------
+    Parameters:
+        values (numpy array or scalar): values for one row.
+    ----------
+    Returns:
+        line (str): comma-separated values, ending in \\r\\n.
+    """
+    return ','.join(map(str, np.ravel(values).tolist())) + '\r\n'
+
+def _fast_rowcount(filepath):
+    """
+    Count the rows of a csv file by counting newlines in 1 MB chunks, without parsing it.
+    ----------
+    Parameters:
+        filepath (str): path to the file.
+    ----------
+    Returns:
+        n_rows (int): number of lines in the file.
+    """
+    with open(filepath, 'rb') as f:
+        return sum(chunk.count(b'\n') for chunk in iter(lambda: f.read(1<<20), b''))
+
+def _write_lines(files, batches):
+    """
+    Write batches of csv lines to their files (one write call per file), then empty the batches.
+    All of the text is built before anything is written, but if a write itself fails (e.g. the
+    disk is full) the files written before it keep the batch, so they can end up with different
+    numbers of rows.
+    ----------
+    Parameters:
+        files (list): open files to append to.
+        batches (list): list of csv lines waiting to be written for each file.
+    """
+    texts = [''.join(batch) for batch in batches]
+    for batch in batches:
+        batch.clear()
+    for f, text in zip(files, texts):
+        f.write(text)
+
+class _BackgroundWriter:
+    '''
+    Append rows of csv lines to a set of files from a background thread, so that disk writes
+    overlap with downloading and processing instead of holding them up. Lines are written in
+    batches (one write call per file) once write_batch rows are waiting or flush_interval
+    seconds have passed. Every file gets its line of every row, so the files stay the same length
+    (unless a write fails partway through a batch, see _write_lines). After a failed write the
+    error is raised from the next put or close, and no more rows are written.
+    '''
+
+    def __init__(self, files, write_batch=64, flush_interval=0.2, max_queued=256):
+        self.files = files
+        self.write_batch = write_batch
+        self.flush_interval = flush_interval
+        self.queue = Queue(maxsize=max_queued) # bounded, so a slow disk slows down producers
+        self.error = None
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def put(self, lines):
+        '''
+        Queue one row: a tuple with one csv line for each file.
+        '''
+        if self.error is not None:
+            raise self.error
+        self.queue.put(lines)
+
+    def close(self):
+        '''
+        Write all queued rows and stop the background thread.
+        '''
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def _run(self):
+        batches = tuple([] for f in self.files)
+        last_write = monotonic()
+        while True:
+            try:
+                lines = self.queue.get(timeout=max(self.flush_interval - (monotonic() - last_write), 0))
+            except Empty:
+                lines = () # timer ran out
+            if lines is None:
+                break
+            for batch, line in zip(batches, lines):
+                batch.append(line)
+            if len(batches[0]) >= self.write_batch or monotonic() - last_write >= self.flush_interval:
+                self._write(batches)
+                last_write = monotonic()
+        self._write(batches)
+
+    def _write(self, batches):
+        # After a failed write, keep emptying the queue (so producers don't block) but stop writing
+        if self.error is None and len(batches[0]) > 0:
+            try:
+                _write_lines(self.files, batches)
+            except Exception as err:
+                self.error = err
+        for batch in batches:
+            batch.clear()
+
+def _binned_median(x, y, n_bins):
+    """
+    Median of y in n_bins equal-width bins of x (same result as scipy's
+    binned_statistic(x, y, 'median', bins=n_bins)). Sorts the data once and finds the
+    bin boundaries with a binary search, instead of searching and sorting for every bin.
+    ----------
+    Parameters:
+        x (numpy array): values to bin by (e.g. folded time)
+        y (numpy array): values to take the median of (e.g. folded flux)
+        n_bins (int): number of bins
+    ----------
+    Returns:
+        binned (numpy array): median of y in each bin (NaN for empty bins)
+        bin_edges (numpy array): the n_bins+1 bin edges
+    """
+    order = np.argsort(x)
+    x_sorted = x[order]
+    y_sorted = y[order]
+    bin_edges = np.linspace(x_sorted[0], x_sorted[-1], n_bins+1)
+    bounds = np.searchsorted(x_sorted, bin_edges, side='left')
+    bounds[-1] = len(x_sorted) # last bin includes its right edge
+    binned = np.array([np.median(y_sorted[lo:hi]) if hi > lo else np.nan for lo, hi in zip(bounds[:-1], bounds[1:])])
+    return binned, bin_edges
+
+def _sample_ids(n_curves, pct_transit=49, seed=None):
+    """
+    Randomly choose which stars to download, from the KOI table.
+    ----------
+    Parameters:
+        n_curves: number of curves to download (will be approximate if percentages don't work out).
+        pct_transit: percent of returned dataset that contains a transt.
+        seed: seed for the random number generator (None for a different sample every time).
+    ----------
+    Returns:
+        all_ids (numpy array): KIC IDs of the chosen stars, in random order.
+        ids_labels (numpy array): corresponding labels (1 = transit, 0 = no transit)
+    """
+    rng = np.random.default_rng(seed)
+    ids_by_disposition = _koi().groupby('koi_disposition', observed=True)['kepid'] # single pass over the table
+    # Get IDs of non-transit curves
+    all_nontransit_ids = ids_by_disposition.get_group('FALSE POSITIVE').to_numpy(dtype=np.int64)
+    nontransit_ids = rng.choice(all_nontransit_ids, size = int(n_curves*(1-pct_transit/100)), replace=True)
+    # Get IDs of transit curves
+    all_transit_ids = ids_by_disposition.get_group('CONFIRMED').to_numpy(dtype=np.int64)
+    transit_ids = rng.choice(all_transit_ids, size = int(n_curves*(pct_transit/100)), replace=True)
+    # Labels are known at sampling time, so keep them aligned with the IDs (1 = transit, 0 = no transit)
+    all_ids = np.concatenate((nontransit_ids, transit_ids))
+    ids_labels = np.concatenate((np.zeros(len(nontransit_ids), dtype=int), np.ones(len(transit_ids), dtype=int)))
+    # Randomize id list
+    shuffle = rng.permutation(len(all_ids))
+    return all_ids[shuffle], ids_labels[shuffle]
+
+def _write_parquet_batch(writer, rows):
+    """
+    Write buffered rows to a parquet file as one record batch, then empty the buffers.
+    ----------
+    Parameters:
+        writer (pyarrow ParquetWriter): open parquet file to add to.
+        rows (dict): lists of values waiting to be written, for each column of writer.schema.
+    """
+    if len(rows['label']) > 0:
+        writer.write_batch(pa.RecordBatch.from_pydict(rows, schema=writer.schema))
+    for column in rows.values():
+        column.clear()
+
+def _rate_limited(err):
+    """
+    Whether an error raised while querying or downloading from MAST is a rate limit (HTTP 429).
+    ----------
+    Parameters:
+        err (Exception): the error raised.
+    ----------
+    Returns:
+        rate_limited (bool): True if the request should be retried later.
+    """
+    status = getattr(getattr(err, 'response', None), 'status_code', None)
+    if status == 429:
+        return True
+    # Match 429 as a whole word, so that KIC IDs in file names in the message don't count
+    message = str(err)
+    return isinstance(err, LightkurveError) and (re.search(r'\b429\b', message) is not None
+                                                 or 'Too Many Requests' in message)
+
+def _download_lc(star, max_retries=5, backoff=2):
+    """
+    Download all long cadence Kepler quarters of one star. If MAST rate-limits us
+    (HTTP 429), wait and retry with exponential backoff. File downloads that fail are
+    reported by astroquery as an error status rather than an HTTPError, which Lightkurve
+    turns into a LightkurveError carrying the MAST message, so that is checked for 429 too.
+    ----------
+    Parameters:
+        star (int): KIC ID of the star.
+        max_retries (int): number of attempts before giving up.
+        backoff (float): seconds to wait before the first retry (doubled for every retry).
+    ----------
+    Returns:
+        lc_collection (lightcurve collection): all quarters of lightcurve data for the star.
+    """
+    for attempt in range(max_retries):
+        try:
+            return lk.search_lightcurve(f'KIC{star}', author='Kepler', cadence='long').download_all()
+        except Exception as err:
+            if not _rate_limited(err) or attempt == max_retries-1:
+                raise
+            sleep(backoff * 2**attempt)
+
+def _cached_lc(star):
+    """
+    Read all long cadence Kepler quarters of one star that are in the Lightkurve cache.
+    A file that can't be read (e.g. one that is still being written, or was cut short by an
+    interrupted download) counts as a cache miss.
+    ----------
+    Parameters:
+        star (int): KIC ID of the star.
+    ----------
+    Returns:
+        lc_collection (lightcurve collection): the cached quarters, or None if there are none
+                (or one of them can't be read).
+    """
+    cache_dir = lk.config.get_cache_dir()
+    cached = sorted(glob(os.path.join(cache_dir, 'mastDownload', 'Kepler', f'kplr{star:09d}_lc_*', f'kplr{star:09d}-*_llc.fits')))
+    if len(cached) == 0:
+        return None
+    try:
+        return lk.LightCurveCollection([lk.read(path) for path in cached])
+    except (LightkurveError, OSError): # Lightkurve raises LightkurveError for corrupt files
+        return None
+
+def _get_lc(star):
+    """
+    Get all long cadence Kepler quarters of one star, reading them straight from the
+    Lightkurve cache if they have already been downloaded. download_all() itself skips files
+    that are already cached, but search_lightcurve() still queries MAST for every star,
+    which is what this saves.
+    NOTE: if a previous download was interrupted, only the quarters that made it into the
+          cache are returned (delete the star's cache directory to force a fresh download,
+          and its file in the "stitched" cache folder if there is one, see _stitched_lc).
+    ----------
+    Parameters:
+        star (int): KIC ID of the star.
+    ----------
+    Returns:
+        lc_collection (lightcurve collection): all quarters of lightcurve data for the star.
+    """
+    lc_collection = _cached_lc(star)
+    if lc_collection is not None:
+        return lc_collection
+    return _download_lc(star)
+
+def _check_inputs(downsize_method):
+    """
+    Check the processing options passed to the collect_curves functions.
+    """
+    if downsize_method not in ['interpolate', 'truncate']:
+       raise ValueError('downsize_method must be "interpolate" or "truncate"')
+
+def _iter_curves(all_ids, ids_labels, n_timesteps=1000, downsize_method='interpolate', phase_fold=False, smooth=False, n_workers=8, use_processes=False):
+    """
+    Download and process the lightcurves of many stars concurrently. This is the engine behind
+    all of the collect_curves functions, which only differ in where they put the results.
+    Downloads are network-bound, so a small pool of threads gives a near-linear speedup; the
+    pool size bounds the number of simultaneous requests so we don't hammer MAST. A pool of
+    processes also spreads the CPU-bound work (FITS parsing, stitching, BLS) across cores.
+    ----------
+    Parameters:
+        all_ids (numpy array): KIC IDs of the stars to download.
+        ids_labels (numpy array): corresponding labels (1 = transit, 0 = no transit)
+        n_timesteps, downsize_method, phase_fold, smooth: see collect_curves_tofiles.
+        n_workers (int): maximum number of simultaneous downloads.
+        use_processes (bool): if True, use a pool of processes instead of threads.
+    ----------
+    Yields (in the order stars finish, once for every time a star appears in all_ids):
+        i (int): index of the star in all_ids
+        flux (numpy array): flux values, of length n_timesteps
+        time (numpy array): corresponding time values
+        label (int): transit label (1 = transit, 0 = no transit)
+    """
+    target = np.arange(n_timesteps, dtype=np.float64) # grid to interpolate onto (same as np.linspace(0, n_timesteps-1, n_timesteps))
+    print(f'Downloading {len(all_ids)} light curves')
+    # Stars can be sampled more than once. Download each of them only once: two workers downloading
+    # the same star at the same time would read each other's half-written files from the cache.
+    stars, star_index = np.unique(all_ids, return_inverse=True)
+    pool = (ProcessPoolExecutor if use_processes else ThreadPoolExecutor)(max_workers=n_workers)
+    futures = {pool.submit(_process_curve, int(star), target, downsize_method, phase_fold, smooth): j
+               for j, star in enumerate(stars)}
+    n_done = 0
+    try:
+        for future in as_completed(futures):
+            flux, time = future.result()
+            for i in np.flatnonzero(star_index == futures[future]):
+                print(f'\tStar {n_done}', end='\r')
+                n_done += 1
+                yield int(i), flux, time, ids_labels[i]
+    finally:
+        # Don't keep downloading in the background if the caller stops early or a download fails
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def collect_curves(n_curves, n_timesteps=1000, downsize_method='interpolate', pct_transit=49, n_workers=8, use_processes=False, seed=None):
     """
     Collect raw light curves into flux and time arrays (of shape [n_curves, n_timesteps]).
     Construct corresponding array (of shape [n_curves]) containing labels (1 = transit, 0 = no transit).
@@ -82,61 +579,34 @@ def collect_curves(n_curves, n_timesteps=1000, downsize_method='interpolate', pc
         downsize_method: method to force curves to the n_timesteps. Options are 'interpolate' or 'truncate'.
         pct_transit: percent of returned dataset that contains a transt. Default is 49, which is 
                     the overall perentage of the 150,000 available Keplar curves that have transits. 
+        n_workers: number of light curves to download simultaneously.
+        use_processes: if True, download and process curves in n_workers separate processes instead
+                       of threads, to also spread the CPU-bound work across cores.
+        seed: seed for choosing which stars to download (None for a different sample every time).
     ----------
     Returns:
-        all_curves: numpy array of shape [n_curves, n_timesteps] containing light curve flux values
-        all_times: numpy array of shape [n_curves, n_timesteps] containing light curve time values
-        all_labels: 1-dimensional array containing correponding transit labels (1 = transit, 0 = no transit)
+        all_curves: float32 numpy array of shape [n_curves, n_timesteps] containing light curve flux values
+        all_times: float32 numpy array of shape [n_curves, n_timesteps] containing light curve time values
+        all_labels: 1-dimensional int8 array containing correponding transit labels (1 = transit, 0 = no transit)
     """
-    # Check inputs
-    if downsize_method not in ['interpolate', 'truncate']:
-       raise ValueError('downsize_method must be "interpolate" or "truncate"')
-    # Get IDs of non-transit curves
-    data = pd.read_csv('Data/exoplanet_archive_KOIs.csv')
-    all_nontransit_ids = data.loc[data['koi_disposition'] == 'FALSE POSITIVE']['kepid'].to_list()
-    nontransit_ids = np.random.choice(all_nontransit_ids, size = int(n_curves*(1-pct_transit/100)))
-    all_ids = np.copy(nontransit_ids) 
-    # Get IDs of transit curves 
-    all_transit_ids = data.loc[data['koi_disposition'] == 'CONFIRMED']['kepid'].to_list()
-    transit_ids = np.random.choice(all_transit_ids, size = int(n_curves*(pct_transit/100)))
-    all_ids = np.concatenate((all_ids, transit_ids))
-    # Randomize id list 
-    all_ids = all_ids[np.random.permutation(len(all_ids))]
-    # Fill array with transit and non-transit curves
-    all_curves = np.zeros((len(all_ids), n_timesteps))
-    all_times = np.zeros((len(all_ids), n_timesteps))
-    all_labels = np.zeros(len(all_ids))
-    i = 0
-    print(f'Downloading {len(all_ids)} light curves')
-    for star in all_ids:
-        star = int(star)
-        print(f'\tStar {i}', end='\r')
-        # Download full light curve
-        curve = lk.search_lightcurve(f'KIC{star}', author='Kepler', cadence='long').download_all()
-        # "Stich" together quarters
-        time, flux, flux_err, quality = stitch_quarters(curve)
-        # Set poor quality data to NaN
-        good = (quality == 0) * (flux_err > 0) * (np.isfinite(time)) * (np.isfinite(flux)) * (np.isfinite(flux_err))
-        flux[np.invert(good)] = np.NaN
-        # Force to length n_timesteps
-        if downsize_method == 'interpolate':
-            flux = np.interp(np.linspace(0,n_timesteps-1,n_timesteps), np.linspace(0,n_timesteps-1,len(flux)), flux)
-            time = np.interp(np.linspace(0,n_timesteps-1,n_timesteps), np.linspace(0,n_timesteps-1,len(time)), time)
-        if downsize_method == 'truncate':
-            flux = flux[0:n_timesteps]
-            time = time[0:n_timesteps]
-        # Get label
-        label = int(1) if id in transit_ids else int(0)
-        # Add time and flux to arrays
-        all_times[i] = time
-        all_curves[i] = flux
-        all_labels[i] = label
-        i += 1
+    _check_inputs(downsize_method)
+    all_ids, ids_labels = _sample_ids(n_curves, pct_transit, seed)
+    # Fill array with transit and non-transit curves (float32 halves the memory, and is what models train on)
+    all_curves = np.zeros((len(all_ids), n_timesteps), dtype=np.float32)
+    all_times = np.zeros((len(all_ids), n_timesteps), dtype=np.float32)
+    all_labels = np.zeros(len(all_ids), dtype=np.int8)
+    curves = _iter_curves(all_ids, ids_labels, n_timesteps, downsize_method, n_workers=n_workers, use_processes=use_processes)
+    with closing(curves):
+        for i, flux, time, label in curves:
+            # Add time and flux to arrays (in the original, randomized order)
+            all_times[i] = time
+            all_curves[i] = flux
+            all_labels[i] = label
 
     return all_curves, all_times, all_labels
 
 
-def collect_curves_tofiles(n_curves, n_timesteps=1000, downsize_method='interpolate', phase_fold=False, smooth=False, pct_transit=49, savepath='../LC_Data'):
+def collect_curves_tofiles(n_curves, n_timesteps=1000, downsize_method='interpolate', phase_fold=False, smooth=False, pct_transit=49, savepath='../LC_Data', n_workers=8, use_processes=False, write_batch=64, seed=None):
     """
     Add raw light curves (row-wise) into csv files storing flux, time, and labels (1 = transit, 0 = no transit).
     Every call to this function will add rows to these csv files.
@@ -149,33 +619,28 @@ def collect_curves_tofiles(n_curves, n_timesteps=1000, downsize_method='interpol
         n_timesteps: number of timesteps to interpolate or truncate to. If "phase fold", number of bins to
                      use to bin folded lightcurve.
         downsize_method: method to force curves to n_timesteps. Options are 'interpolate' or 'truncate'.
-        smooth: if True, will smooth returned lightcurves, if False will not.
+        smooth: if True, will smooth returned lightcurves, if False will not. Phase folded
+                lightcurves are always flattened before folding, so this only affects
+                curves that are not phase folded.
         phase_fold: if True, will phase fold returned lightcurves, if False will not.
         pct_transit: percent of returned dataset that contains a transt. Default is 49, which is
                     the overall perentage of the 150,000 available Keplar curves that have transits.
         savepath = path in which to create the stored files.
+        n_workers: number of light curves to download simultaneously. Rows are written
+                   in the order downloads finish.
+        use_processes: if True, download and process curves in n_workers separate processes instead
+                       of threads, to also spread the CPU-bound work across cores.
+        write_batch: number of rows to buffer in memory before writing them to the files (rows are
+                     also written at least every 0.2 seconds).
+        seed: seed for choosing which stars to download (None for a different sample every time).
     ----------
     Generates or adds to the following 3 files:
         savepath/flux_all_[n_timesteps]_[pct_transits].csv: flux values, with each row representing one curve.
         savepath/time_all_[n_timesteps]_[pct_transits].csv: corresponding time values
         savepath/labels_all_[n_timesteps]_[pct_transits].csv: corresponding labels (1 per row)
     """
-    # Check inputs
-    if downsize_method not in ['interpolate', 'truncate']:
-       raise ValueError('downsize_method must be "interpolate" or "truncate"')
-    if not all(item in [phase_fold, smooth] for item in [True, False]):
-       raise ValueError('phase_fold and smooth must be both be either True or False')
-    # Get IDs of non-transit curves
-    data = pd.read_csv('Data/exoplanet_archive_KOIs.csv')
-    all_nontransit_ids = data.loc[data['koi_disposition'] == 'FALSE POSITIVE']['kepid'].to_list()
-    nontransit_ids = np.random.choice(all_nontransit_ids, size = int(n_curves*(1-pct_transit/100)))
-    all_ids = np.copy(nontransit_ids)
-    # Get IDs of transit curves
-    all_transit_ids = data.loc[data['koi_disposition'] == 'CONFIRMED']['kepid'].to_list()
-    transit_ids = np.random.choice(all_transit_ids, size = int(n_curves*(pct_transit/100)))
-    all_ids = np.concatenate((all_ids, transit_ids))
-    # Randomize id list
-    all_ids = all_ids[np.random.permutation(len(all_ids))]
+    _check_inputs(downsize_method)
+    all_ids, ids_labels = _sample_ids(n_curves, pct_transit, seed)
     # Create files if they don't exist, else check that they have the same length
     filepaths = []
     filelengths = []
@@ -184,70 +649,78 @@ def collect_curves_tofiles(n_curves, n_timesteps=1000, downsize_method='interpol
         filepaths.append(filepath)
         if os.path.exists(filepath) == False:
             print(f'Creating {filepath} to store {tag}')
-            open(filepath, 'w')
-            filelengths.append([0])
+            open(filepath, 'w').close()
+            filelengths.append(0)
         else:
             print(f'Adding {tag} to {filepath}')
-            filelengths.append(len(pd.read_csv(filepath, header=None, delimiter=',')))
+            filelengths.append(_fast_rowcount(filepath))
     if all(element == filelengths[0] for element in filelengths) == False:
         raise Exception(f'{filepaths[0]}, {filepaths[1]}, and {filepaths[2]}, have different number of rows ({filelengths[0]},{filelengths[1]}, and {filelengths[2]}).')
-    # Download curves and append to files
-    with open(rf'{filepaths[0]}','a') as f1, open(rf'{filepaths[1]}','a') as f2, open(rf'{filepaths[2]}','a') as f3:
-        writer1=csv.writer(f1)
-        writer2=csv.writer(f2)
-        writer3=csv.writer(f3)
-        i = 0
-        print(f'Downloading {len(all_ids)} light curves')
-        for star in all_ids:
-            star = int(star)
-            # Get label
-            label = 1 if (star in transit_ids) else 0
-            print(f'\tStar {i}', end='\r')
-            # Download full light curve
-            curve = lk.search_lightcurve(f'KIC{star}', author='Kepler', cadence='long').download_all()
-            # "Stich" together quarters
-            time, flux, flux_err, quality = stitch_quarters(curve)
-            if smooth:
-                # Smooth to remove stellar variability
-                flux = flux/medfilt(flux,51)
-            if phase_fold:
-                # Phase fold
-                curve = curve.stitch().flatten(window_length=901).remove_outliers()
-                period = np.linspace(1, 30, 10000) # periods to search
-                # Create a BLSPeriodogram
-                bls = curve.to_periodogram(method='bls', period=period, frequency_factor=500)
-                period = bls.period_at_max_power
-                t0 = bls.transit_time_at_max_power
-                dur = bls.duration_at_max_power
-                folded = curve.fold(period=period, epoch_time=t0)
-                folded_flux = folded.flux.value
-                folded_time = folded.time.value
-                planet_model = bls.get_transit_model(period=period,
-                                       transit_time=t0,
-                                       duration=dur).fold(period, t0)
-                binned, bin_edges, binnumber = binned_statistic(folded_time, folded_flux, 'median', bins = n_timesteps)
-                folded_smoothed_time = bin_edges[1:]
-                folded_smoothed_flux = medfilt(binned,3)
-                writer1.writerow(np.array(folded_smoothed_flux))
-                writer2.writerow(np.array(folded_smoothed_time))
-                writer3.writerow(np.array([label]))
-                i += 1
-                continue
-            # Set poor quality data to NaN
-            good = (quality == 0) * (flux_err > 0) * (np.isfinite(time)) * (np.isfinite(flux)) * (np.isfinite(flux_err))
-            flux[np.invert(good)] = np.NaN
-            # Force to length n_timesteps
-            if downsize_method == 'interpolate':
-                flux = np.interp(np.linspace(0,n_timesteps-1,n_timesteps), np.linspace(0,n_timesteps-1,len(flux)), flux)
-                time = np.interp(np.linspace(0,n_timesteps-1,n_timesteps), np.linspace(0,n_timesteps-1,len(time)), time)
-            if downsize_method == 'truncate':
-                flux = flux[0:n_timesteps]
-                time = time[0:n_timesteps]
-            # Add to csv files
-            writer1.writerow(np.array(flux))
-            writer2.writerow(np.array(time))
-            writer3.writerow(np.array([label]))
-            i += 1
+    # Download curves and append to files. Downloads run concurrently, and rows are written to disk
+    # by a single background thread. The writer is closed first, so we keep the rows we have even if
+    # a download fails or the user interrupts.
+    # newline='' so that the \r\n line endings are written as-is on every platform
+    with open(rf'{filepaths[0]}','a',newline='',buffering=1<<20) as f1, open(rf'{filepaths[1]}','a',newline='',buffering=1<<20) as f2, \
+         open(rf'{filepaths[2]}','a',newline='',buffering=1<<20) as f3, \
+         closing(_iter_curves(all_ids, ids_labels, n_timesteps, downsize_method, phase_fold, smooth, n_workers, use_processes)) as curves, \
+         closing(_BackgroundWriter((f1, f2, f3), write_batch)) as writer:
+        for i, flux, time, label in curves:
+            writer.put((_csv_line(flux), _csv_line(time), _csv_line(label)))
+
+def collect_curves_toparquet(n_curves, n_timesteps=1000, downsize_method='interpolate', phase_fold=False, smooth=False, pct_transit=49, savepath='../LC_Data', n_workers=8, use_processes=False, write_batch=64, seed=None):
+    """
+    Add light curves (row-wise) into a parquet dataset storing flux, time, labels (1 = transit, 0 = no transit),
+    and Kepler IDs. Flux and time are stored as compressed float32, so the files are much smaller and faster
+    to load than the csv files from collect_curves_tofiles.
+    Every call to this function will add a new file to the dataset. Load all of them with pd.read_parquet(dirpath).
+    ----------
+    Parameters:
+        n_curves: number of curves to download (will be approximate if percentages don't work out).
+        n_timesteps: number of timesteps to interpolate or truncate to. If "phase fold", number of bins to
+                     use to bin folded lightcurve.
+        downsize_method: method to force curves to n_timesteps. Options are 'interpolate' or 'truncate'.
+        smooth: if True, will smooth returned lightcurves, if False will not. Phase folded
+                lightcurves are always flattened before folding, so this only affects
+                curves that are not phase folded.
+        phase_fold: if True, will phase fold returned lightcurves, if False will not.
+        pct_transit: percent of returned dataset that contains a transt. Default is 49, which is
+                    the overall perentage of the 150,000 available Keplar curves that have transits.
+        savepath = path in which to create the dataset.
+        n_workers: number of light curves to download simultaneously. Rows are written
+                   in the order downloads finish.
+        use_processes: if True, download and process curves in n_workers separate processes instead
+                       of threads, to also spread the CPU-bound work across cores.
+        write_batch: number of rows to buffer in memory before writing them to the file.
+        seed: seed for choosing which stars to download (None for a different sample every time).
+    ----------
+    Generates or adds to the following dataset:
+        savepath/curves_[n_timesteps]_[pct_transits]/: parquet files with columns 'flux', 'time' (one curve
+                per row), 'label', and 'kepid'.
+    """
+    _check_inputs(downsize_method)
+    all_ids, ids_labels = _sample_ids(n_curves, pct_transit, seed)
+    # Create a new file in the dataset (parquet files can't be appended to)
+    dirpath = f"{savepath}/curves_{n_timesteps}_{pct_transit}"
+    os.makedirs(dirpath, exist_ok=True)
+    filepath = f"{dirpath}/part-{time_ns()}.parquet"
+    print(f'Adding curves to {dirpath}')
+    schema = pa.schema([('flux', pa.list_(pa.float32())), ('time', pa.list_(pa.float32())),
+                        ('label', pa.int8()), ('kepid', pa.int64())])
+    # Download curves and write to the file
+    with pq.ParquetWriter(filepath, schema, compression='zstd', compression_level=3) as writer, \
+         closing(_iter_curves(all_ids, ids_labels, n_timesteps, downsize_method, phase_fold, smooth, n_workers, use_processes)) as curves:
+        rows = {'flux': [], 'time': [], 'label': [], 'kepid': []} # rows waiting to be written
+        try:
+            for i, flux, time, label in curves:
+                rows['flux'].append(np.asarray(flux, dtype=np.float32))
+                rows['time'].append(np.asarray(time, dtype=np.float32))
+                rows['label'].append(int(label))
+                rows['kepid'].append(int(all_ids[i]))
+                if len(rows['label']) >= write_batch:
+                    _write_parquet_batch(writer, rows)
+        finally:
+            # Keep the rows we have, even if a download fails or the user interrupts
+            _write_parquet_batch(writer, rows)
 
 #### Functions for use with NNs ####
 import torch